@@ -1,22 +1,55 @@
 #!/usr/bin/env python3
+import errno
+import fcntl
+import functools
+import hashlib
+import json
 import os
+import re
 import shutil
+import stat
 import subprocess
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
 LAMMPS_TAG = os.environ.get("LAMMPS_TAG", "patch_10Sep2025")
 BASE_DIR = Path(__file__).resolve().parent
 LAMMPS_DIR = BASE_DIR / "lammps"
+LAMMPS_TAG_DIR = BASE_DIR / f"lammps-{LAMMPS_TAG}"
 SRC_DIR = LAMMPS_DIR / "src"
+INSTALLED_PACKAGES = SRC_DIR / ".installed_packages"
+BUILD_STATE = SRC_DIR / ".build_state.json"
 
 # Override with: PACKAGES="yes-molecule yes-kspace"
 PACKAGES = os.environ.get("PACKAGES", "yes-molecule").split()
 
+# Install order for packages whose Install.sh reacts to other installed packages
+_PKG_ORDER = [
+  "yes-molecule",
+  "yes-kspace",
+  "yes-manybody",
+  "yes-rigid",
+  "yes-extra-molecule",
+  "yes-extra-pair",
+  "yes-extra-fix",
+  "yes-extra-compute",
+]
+
 # Files you actually need from your local code
 CUSTOM_BASENAMES = [
   "lammpsweb",
 ]
 
+# Digests of copied sources and their SRC_DIR targets, keyed by path -> [size, mtime_ns, digest]
+BUILD_CACHE = BASE_DIR / ".build_cache.json"
+BUILD_LOCK = BASE_DIR / ".build.lock"
+
+# Objects compiled by the top-level Makefile, with the EMCC_CFLAGS hash they were built under
+OBJ_DIR = BASE_DIR / "obj"
+EMCC_CFLAGS_HASH = OBJ_DIR / ".emcc_cflags.hash"
+
 LOCATE_FILE = BASE_DIR / "locateFile.js"
 LOCATE_FILE_STUB = """\
 if (typeof Module === "undefined") {
@@ -30,49 +63,179 @@ if (!Module.locateFile) {
 """
 
 
-def read(path: Path) -> str:
-  return path.read_text() if path.exists() else ""
+def _digest(path: Path) -> tuple[int, str]:
+  h = hashlib.blake2b(digest_size=16)
+  size = 0
+  with open(path, "rb") as file:
+    while chunk := file.read(1 << 20):
+      size += len(chunk)
+      h.update(chunk)
+  return size, h.hexdigest()
+
+
+def load_build_cache() -> dict:
+  try:
+    return json.loads(BUILD_CACHE.read_text())
+  except (OSError, ValueError):
+    return {}
+
+
+def save_build_cache(cache: dict) -> None:
+  BUILD_CACHE.write_text(json.dumps(cache, indent=2, sort_keys=True))
+
+
+def cached_digest(path: Path, st: os.stat_result, cache: dict) -> str:
+  # Only rehash when the file changed on disk since the digest was recorded.
+  key = str(path)
+  entry = cache.get(key)
+  if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+    return entry[2]
+  size, digest = _digest(path)
+  cache[key] = [size, st.st_mtime_ns, digest]
+  return digest
+
 
+def _fast_copy(src: Path, dst: Path) -> None:
+  # copy_file_range lets reflink-capable filesystems share extents instead of copying bytes
+  if hasattr(os, "copy_file_range"):
+    try:
+      with open(src, "rb") as s, open(dst, "wb") as d:
+        while os.copy_file_range(s.fileno(), d.fileno(), 1 << 30):
+          pass
+      return
+    except OSError as err:
+      if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+        raise
+  shutil.copyfile(src, dst)
 
-def copy_if_changed(src: Path, dst: Path) -> None:
-  if read(src) != read(dst):
-    dst.parent.mkdir(parents=True, exist_ok=True)
-    shutil.copyfile(src, dst)
-    print(f"updated: {dst.relative_to(BASE_DIR)}")
+
+def copy_if_changed(src: Path, dst: Path, cache: dict | None = None) -> None:
+  if cache is None:
+    cache = {}
+  src_st = os.stat(src)
+  try:
+    dst_st = os.stat(dst)
+  except FileNotFoundError:
+    dst_st = None
+  if dst_st is not None and dst_st.st_size == src_st.st_size:
+    if cached_digest(src, src_st, cache) == cached_digest(dst, dst_st, cache):
+      return
+  dst.parent.mkdir(parents=True, exist_ok=True)
+  _fast_copy(src, dst)
+  cached_digest(dst, os.stat(dst), cache)
+  print(f"updated: {dst.relative_to(BASE_DIR)}")
+
+
+_MAKE_DIRECTORY_LINE = re.compile(r"make(\[\d+\])?: (Entering|Leaving) directory")
+
+
+def _noisy(line: str) -> bool:
+  return _MAKE_DIRECTORY_LINE.match(line) is not None
+
+
+def run_make(args: list[str], cwd: Path, env: dict | None = None) -> None:
+  # Stream make output line by line, dropping directory chatter
+  argv = ["make", "--no-print-directory", *args]
+  with subprocess.Popen(
+    argv,
+    cwd=str(cwd),
+    env=env,
+    stdout=subprocess.PIPE,
+    stderr=subprocess.STDOUT,
+    text=True,
+    errors="replace",
+    bufsize=1,
+  ) as proc:
+    for line in proc.stdout:
+      if not _noisy(line):
+        # Flush so lines stay ordered with output children write to the fd directly
+        print(line, end="", flush=True)
+  if proc.returncode:
+    raise subprocess.CalledProcessError(proc.returncode, argv)
 
 
 def ensure_clone() -> None:
-  if LAMMPS_DIR.is_dir():
+  if LAMMPS_DIR.is_dir() and not LAMMPS_DIR.is_symlink():
+    # Checkout from before per-tag clones; remove it to switch tags
     return
-  print("Cloning LAMMPS ...")
-  subprocess.check_call(
-    [
-      "git",
-      "clone",
-      "--depth",
-      "1",
-      "--branch",
-      LAMMPS_TAG,
-      "https://github.com/lammps/lammps.git",
-      str(LAMMPS_DIR),
-    ],
-    cwd=BASE_DIR,
-  )
+  if not LAMMPS_TAG_DIR.is_dir():
+    # Clone under a temporary name so an interrupted clone is never mistaken for a complete one
+    partial = LAMMPS_TAG_DIR.with_name(LAMMPS_TAG_DIR.name + ".partial")
+    shutil.rmtree(partial, ignore_errors=True)
+    print(f"Cloning LAMMPS {LAMMPS_TAG} ...")
+    subprocess.check_call(
+      [
+        "git",
+        "clone",
+        "--filter=blob:none",
+        "--sparse",
+        "--depth",
+        "1",
+        "--branch",
+        LAMMPS_TAG,
+        "https://github.com/lammps/lammps.git",
+        str(partial),
+      ],
+      cwd=BASE_DIR,
+    )
+    # Only fetch blobs for the trees the build compiles from
+    subprocess.check_call(
+      ["git", "-C", str(partial), "sparse-checkout", "set", "src", "lib", "cmake"],
+      cwd=BASE_DIR,
+    )
+    partial.rename(LAMMPS_TAG_DIR)
+  if LAMMPS_DIR.is_symlink() and LAMMPS_DIR.resolve() == LAMMPS_TAG_DIR.resolve():
+    return
+  LAMMPS_DIR.unlink(missing_ok=True)
+  LAMMPS_DIR.symlink_to(LAMMPS_TAG_DIR.name, target_is_directory=True)
+  # Objects in obj/ were compiled from the previously linked tag
+  shutil.rmtree(OBJ_DIR, ignore_errors=True)
+  print(f"linked: {LAMMPS_DIR.relative_to(BASE_DIR)} -> {LAMMPS_TAG_DIR.name}")
+
+def _pkg_rank(pkg: str) -> int:
+  return _PKG_ORDER.index(pkg) if pkg in _PKG_ORDER else len(_PKG_ORDER)
+
+
+def load_installed_packages() -> list[str]:
+  try:
+    return json.loads(INSTALLED_PACKAGES.read_text())
+  except (OSError, ValueError):
+    return []
+
 
 def install_packages():
-  if not PACKAGES:
+  wanted = sorted(PACKAGES)
+  installed = load_installed_packages()
+  if wanted == installed:
     return
-  cmd = ["make"] + PACKAGES
-  print("Installing packages:", " ".join(PACKAGES))
-  subprocess.check_call(" ".join(cmd), shell=True, cwd=str(SRC_DIR))
+  added = [pkg for pkg in PACKAGES if pkg not in installed]
+  removed = [pkg for pkg in installed if pkg not in wanted and pkg.startswith("yes-")]
+  # Enable dependencies before dependents, and disable in the reverse order
+  targets = sorted(added, key=_pkg_rank)
+  targets += ["no-" + pkg[len("yes-"):] for pkg in sorted(removed, key=_pkg_rank, reverse=True)]
+  if targets:
+    # Package targets edit shared Makefile.package* files, so they run serially
+    print("Installing packages:", " ".join(targets))
+    run_make(targets, SRC_DIR)
+  INSTALLED_PACKAGES.write_text(json.dumps(wanted))
 
 def copy_custom_sources():
-  for base in CUSTOM_BASENAMES:
-    for ext in (".cpp", ".h"):
-      src = BASE_DIR / "lammpsweb" / f"{base}{ext}"
-      dst = SRC_DIR / f"{base}{ext}"
-      if src.exists():
-        copy_if_changed(src, dst)
+  cache = load_build_cache()
+  pairs = [
+    (BASE_DIR / "lammpsweb" / f"{base}{ext}", SRC_DIR / f"{base}{ext}")
+    for base in CUSTOM_BASENAMES
+    for ext in (".cpp", ".h")
+  ]
+
+  def copy_pair(pair: tuple[Path, Path]) -> None:
+    src, dst = pair
+    if src.exists():
+      copy_if_changed(src, dst, cache)
+
+  # Overlap the stat/hash/copy IO of each pair; list() re-raises worker errors
+  with ThreadPoolExecutor(max_workers=8) as pool:
+    list(pool.map(copy_pair, pairs))
+  save_build_cache(cache)
 
 def remove_broken_imd():
   target_cpp = SRC_DIR / "fix_imd.cpp"
@@ -85,33 +248,90 @@ def remove_broken_imd():
 
 
 
+def _total_memory_mb() -> int | None:
+  try:
+    return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // (1 << 20)
+  except (AttributeError, ValueError, OSError):
+    return None
+
+
+def _jobs() -> int:
+  # Override with: JOBS=4, or cap by memory with MAKE_MEMORY_PER_JOB_MB=2048
+  jobs = int(os.environ.get("JOBS") or os.cpu_count() or 4)
+  per_job = int(os.environ.get("MAKE_MEMORY_PER_JOB_MB") or 0)
+  total = _total_memory_mb()
+  if per_job > 0 and total:
+    jobs = min(jobs, total // per_job)
+  return max(jobs, 1)
+
+
 def refresh_metadata():
   print("Generating LAMMPS style and package headers ...")
   subprocess.check_call(['sh', 'Make.sh', 'style'], cwd=str(SRC_DIR))
   subprocess.check_call(['sh', 'Make.sh', 'packages'], cwd=str(SRC_DIR))
-  subprocess.check_call(['make', 'lmpinstalledpkgs.h'], cwd=str(SRC_DIR))
-  subprocess.check_call(['make', 'gitversion'], cwd=str(SRC_DIR))
+  run_make(['lmpinstalledpkgs.h'], SRC_DIR)
+  run_make(['gitversion'], SRC_DIR)
 
 
+# Native objects land in Obj_<machine>, which clean-<machine> removes
+NATIVE_MACHINE = "serial"
+
 def build_native_once():
-  print("Native prebuild skipped (not required for wasm build) ...")
+  # The wasm link does not consume native objects; opt in with NATIVE_PREBUILD=1
+  state = {"tag": LAMMPS_TAG, "packages": sorted(PACKAGES)}
+  try:
+    previous = json.loads(BUILD_STATE.read_text())
+  except (OSError, ValueError):
+    previous = None
+  if previous != state:
+    # Objects from another tag or package set are unsafe to reuse
+    print("Build configuration changed, cleaning native objects ...")
+    run_make([f"clean-{NATIVE_MACHINE}"], SRC_DIR)
+  print("Building native serial LAMMPS ...")
+  run_make(["-j", str(_jobs()), NATIVE_MACHINE], SRC_DIR)
+  BUILD_STATE.write_text(json.dumps(state))
 
-def build_wasm():
-  env = os.environ.copy()
-  if env.get("SINGLE_FILE") == "1":
-    # Request embedded wasm; emscripten picks this from CFLAGS in most Makefile flows
-    extra = env.get("EMCC_CFLAGS", "")
-    flags = extra.split() + ["-s", "SINGLE_FILE=1", "-s", "MODULARIZE=1", "-s", "EXPORT_ES6=1"]
-    env["EMCC_CFLAGS"] = " ".join(flags)
-    print("SINGLE_FILE=1 enabled for emscripten build")
-  print("Building wasm/JS ...")
-  subprocess.check_call("make -j8", shell=True, cwd=str(SRC_DIR), env=env)
-
-def ensure_emcc():
-  if shutil.which("emcc") is None:
+def _scan_dir(directory: Path) -> Iterator[tuple[str, os.stat_result]]:
+  # scandir hands back lstat results from the directory read, one syscall per entry
+  try:
+    with os.scandir(directory) as entries:
+      for entry in entries:
+        yield entry.name, entry.stat(follow_symlinks=False)
+  except FileNotFoundError:
+    return
+
+def invalidate_objects_on_flag_change(cflags: str) -> None:
+  # make tracks sources, not flags: drop objects compiled under different or unknown EMCC_CFLAGS
+  flag_hash = hashlib.blake2b(cflags.encode()).hexdigest()
+  try:
+    previous = EMCC_CFLAGS_HASH.read_text().strip()
+  except OSError:
+    previous = None
+  if previous == flag_hash:
+    return
+  stale = [
+    OBJ_DIR / name
+    for name, st in _scan_dir(OBJ_DIR)
+    if name.endswith(".o") and stat.S_ISREG(st.st_mode)
+  ]
+  for obj in stale:
+    obj.unlink(missing_ok=True)
+  if stale:
+    print(f"EMCC_CFLAGS changed, removed {len(stale)} stale objects")
+  OBJ_DIR.mkdir(parents=True, exist_ok=True)
+  EMCC_CFLAGS_HASH.write_text(flag_hash + "\n")
+
+@functools.lru_cache(maxsize=1)
+def _emcc_path() -> str | None:
+  return shutil.which("emcc")
+
+def ensure_emcc() -> str:
+  emcc = _emcc_path()
+  if emcc is None:
     raise RuntimeError(
       "Emscripten compiler 'emcc' not found on PATH. Activate emsdk before running build.py."
     )
+  return emcc
 
 def ensure_locate_file():
   if LOCATE_FILE.exists():
@@ -119,25 +339,52 @@ def ensure_locate_file():
   LOCATE_FILE.write_text(LOCATE_FILE_STUB)
   print(f"created: {LOCATE_FILE.relative_to(BASE_DIR)}")
 
+def emscripten_cache_key() -> str:
+  # EM_CACHE holds the sysroot (libc, libc++, ports), which Emscripten builds with
+  # its own flags and already splits by variant; only the toolchain version matters
+  output = subprocess.run(
+    [ensure_emcc(), "--version"], capture_output=True, text=True, check=True
+  ).stdout.strip()
+  version = output.splitlines()[0] if output else ""
+  return hashlib.blake2b(version.encode()).hexdigest()[:12]
+
 def build_bundle():
-  ensure_emcc()
   ensure_locate_file()
   env = os.environ.copy()
-  cache_dir = env.setdefault("EM_CACHE", str(BASE_DIR / ".emscripten_cache"))
-  Path(cache_dir).mkdir(parents=True, exist_ok=True)
-  print("Linking lammps.js via top-level Makefile ...")
-  subprocess.check_call("make wasm", shell=True, cwd=str(BASE_DIR), env=env)
+  if "EM_CACHE" not in env:
+    env["EM_CACHE"] = str(BASE_DIR / f".emscripten_cache-{emscripten_cache_key()}")
+  Path(env["EM_CACHE"]).mkdir(parents=True, exist_ok=True)
+  invalidate_objects_on_flag_change(env.get("EMCC_CFLAGS", ""))
+  jobs = _jobs()
+  env["EMCC_CORES"] = str(jobs)
+  # The top-level Makefile compiles lammps/src into obj/ itself, then links
+  print(f"Building lammps.js via top-level Makefile with {jobs} jobs ...")
+  run_make(["-j", str(jobs), "wasm"], BASE_DIR, env=env)
   if not (BASE_DIR / "lammps.js").exists():
     raise RuntimeError("Emscripten link step completed but did not produce lammps.js")
 
+@contextmanager
+def build_lock():
+  # Serialize concurrent build.py runs that would race on SRC_DIR and EM_CACHE
+  with open(BUILD_LOCK, "w") as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    yield
+
 def main():
+  with build_lock():
+    build()
+
+def build():
+  # Fail on a missing toolchain before starting the network-bound clone
+  ensure_emcc()
   ensure_clone()
+  ensure_locate_file()
   install_packages()
   copy_custom_sources()
   remove_broken_imd()
-  build_native_once()
+  if os.environ.get("NATIVE_PREBUILD") == "1":
+    build_native_once()
   refresh_metadata()
-  build_wasm()
   build_bundle()
 
   print("\nDone.\nArtifacts are left in:", SRC_DIR)